@@ -0,0 +1,69 @@
+"""
+Tests AfmsRoute of the fms_mode plugin, search for the active AFMS mode
+"""
+import pytest
+import numpy as np
+
+
+@pytest.fixture(scope="module")
+def afms_route_(traffic_):
+    """
+    Module-level setup function, for those test functions
+    naming `afms_route_` in their parameter lists.
+    The plugin path is on the module search path after bluesky.init().
+    """
+    import fms_mode
+    yield fms_mode.AfmsRoute
+
+
+def full_scan(route):
+    """
+    Active AFMS mode and own speed from a full backward scan
+    over wpfms_mode[:iactwp] and wpown[:iactwp].
+    """
+    mode = next((value for value in reversed(route.wpfms_mode[:route.iactwp])
+                 if value != 1), 0)
+    own = next((value for value in reversed(route.wpown[:route.iactwp])
+                if value >= 0), -1.)
+    return int(mode), float(own)
+
+
+def test_afms_active(afms_route_):
+    """
+    Test afms_active function.
+
+    Expects the incremental search to give the same mode and own speed
+    as a full backward scan, under random waypoint inserts, deletes,
+    mode and own speed changes, and active waypoint moves.
+    """
+    rng = np.random.RandomState(3)
+    route = afms_route_()
+    for i in range(6):
+        route.addwpt_data(False, i, 'W%d' % i, 0., 0., 0, 0., 0., True)
+
+    for step in range(5000):
+        op = rng.randint(6)
+        nwp = len(route.wpname)
+        if op == 0:
+            # Jump anywhere, e.g. DIRECT
+            route.iactwp = rng.randint(-1, nwp)
+        elif op == 1:
+            # Pass the active waypoint
+            route.iactwp = min(nwp - 1, route.iactwp + 1)
+        elif op == 2:
+            wpidx = rng.randint(nwp)
+            route.wpfms_mode[wpidx] = rng.randint(5)
+            route.afms_changed(wpidx)
+        elif op == 3:
+            wpidx = rng.randint(nwp)
+            route.wpown[wpidx] = rng.choice([-1., 0.7, 200., 230.])
+            route.afms_changed(wpidx)
+        elif op == 4 and nwp < 15:
+            overwrt = bool(rng.randint(2))
+            route.addwpt_data(overwrt, rng.randint(nwp), 'N%d' % step,
+                              0., 0., 0, 0., 0., True)
+        elif op == 5 and nwp > 1:
+            route._del_wpt_data(rng.randint(nwp))
+            route.iactwp = min(route.iactwp, len(route.wpname) - 1)
+
+        assert route.afms_active() == full_scan(route)
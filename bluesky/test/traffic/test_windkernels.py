@@ -0,0 +1,45 @@
+"""
+Tests windkernels module, batch wind interpolation and ISA pressure
+"""
+import numpy as np
+from scipy import ndimage
+from bluesky.tools.aero import vatmos
+from bluesky.traffic.windkernels import interp4d_linear_wrap, isa_pressure
+
+
+def test_isa_pressure():
+    """
+    Test isa_pressure function.
+
+    Expects the same pressure as aero.vatmos, both in the
+    troposphere and above the tropopause.
+    """
+    h = np.linspace(-500., 20000., 206)
+    assert np.allclose(isa_pressure(h), vatmos(h)[0], rtol=1e-12)
+
+
+def test_interp4d_linear_wrap():
+    """
+    Test interp4d_linear_wrap function.
+
+    Expects the same result as a linear ndimage.map_coordinates
+    on the cube with the longitude axis wrapped around.
+    """
+    rng = np.random.RandomState(42)
+    cube = rng.rand(3, 4, 5, 8, 2)
+    npts = 500
+    t = rng.uniform(0., 2., npts)
+    p = rng.uniform(0., 3., npts)
+    lat = rng.uniform(0., 4., npts)
+    lon = rng.uniform(-16., 16., npts)
+
+    out = interp4d_linear_wrap(cube, t, p, lat, lon)
+    assert out.shape == (npts, 2)
+
+    # Append the first longitude column, so the last cell interpolates
+    # back onto the first one
+    wrapped = np.concatenate((cube, cube[:, :, :, :1]), axis=3)
+    coord = np.vstack((t, p, lat, np.mod(lon, cube.shape[3])))
+    for c in range(cube.shape[4]):
+        ref = ndimage.map_coordinates(wrapped[..., c], coord, order=1)
+        assert np.allclose(out[:, c], ref, atol=1e-12)
@@ -6,11 +6,12 @@ Date: 11-12-2018
 """
 
 
-from netCDF4 import date2num, num2date
-from scipy import ndimage, interpolate
+from datetime import datetime
+from netCDF4 import num2date
 import numpy as np
 import iris
-from bluesky.tools.aero import vatmos, kts
+from bluesky.tools.aero import kts
+from .windkernels import interp4d_linear_wrap, isa_pressure
 import bluesky as bs
 
 
@@ -32,27 +33,53 @@ class WindIris:
       |                |                 |
       +-------------- -90 ---------------+
 
+    The wind cubes are stored C-contiguous with shape (time, pressure, lat, lon, 2),
+    with the north and east components interleaved on the last axis. Both
+    components of a grid cell share a cache line and neighbouring longitudes
+    are adjacent in memory; this is faster than one (2, time, pressure, lat, lon)
+    block for scattered lookups.
+
     """
 
+    # Reference epoch of the forecast time axis ('hours since 1900-01-01 00:00:0.0')
+    _EPOCH = datetime(1900, 1, 1)
+
     def __init__(self):
         self.winddim = 3
         self.cubes = []
         self.lat = []
         self.lon = []
         self.pressure = []
+        self._pres_xp = []
+        self._pres_idx = []
         self.t = []
-        self.north_mean = []
-        self.east_mean = []
+        self._t_points = []
+        self._t_idx = []
+        # Linear transformation from lat/lon to grid indices
+        self._lat_offset = self._lat_scale = 0.0
+        self._lon_offset = self._lon_scale = 0.0
+        # Wind cubes, float32 with north/east stacked on the last axis (see class notes)
+        self.wind_mean = []  # ensemble mean
         self.ens = []
-        self.north = []
-        self.east = []
-        self.__ens = []
+        self._has_ens = False
+        self._ensembles = np.array([1])
+        self._time = []
+        self.wind = []  # wind field
+        self.__ens = None
+        # Reusable (time, pressure, lat, lon) grid coordinate buffer, grown on demand
+        self._coord_buf = np.empty((4, 1024))
 
         self.__loaded = False
 
+    def _hours_since_epoch(self, time):
+        """ Convert a datetime (or sequence of datetimes) to hours since the forecast epoch. """
+        if isinstance(time, datetime):
+            return (time - self._EPOCH).total_seconds() * (1.0 / 3600.0)
+        return np.fromiter(((t - self._EPOCH).total_seconds() for t in time), dtype=np.float64) * (1.0 / 3600.0)
+
     def _get_mean(self, lat, lon, pressure, time):
-        time = date2num(time, units='hours since 1900-01-01 00:00:0.0', calendar='gregorian')
-        return self.__interpolate(self.north_mean, self.east_mean, lat, lon, pressure, time)
+        time = self._hours_since_epoch(time)
+        return self.__interpolate(self.wind_mean, lat, lon, pressure, time)
 
     def _get_wind(self, lat, lon, pressure, time, ens=None):
         """
@@ -80,12 +107,11 @@ class WindIris:
         """
 
         if self.__loaded:
-            # TODO: find a faster alternative to date2num
-            time = date2num(time, units='hours since 1900-01-01 00:00:0.0', calendar='gregorian')
+            time = self._hours_since_epoch(time)
 
             if ens:
                 self.__load_ensemble(ens)
-            return self.__interpolate(self.north, self. east, lat, lon, pressure, time)
+            return self.__interpolate(self.wind, lat, lon, pressure, time)
         else:
             return 0, 0
 
@@ -107,18 +133,44 @@ class WindIris:
         self.lat = self.cubes[0].coord('latitude').points
         self.lon = self.cubes[0].coord('longitude').points
         self.pressure = self.cubes[0].coord('pressure_level').points
+        # lookup table from pressure to fractional index, ascending for np.interp
+        self._pres_idx = np.arange(len(self.pressure), dtype=np.float64)
+        self._pres_xp = np.asarray(self.pressure, dtype=np.float64)
+        if len(self._pres_xp) > 1 and self._pres_xp[0] > self._pres_xp[-1]:
+            self._pres_xp = self._pres_xp[::-1].copy()
+            self._pres_idx = self._pres_idx[::-1].copy()
         self.t = self.cubes[0].coord('time').points
+
+        # grid-to-index transformation, longitude axis is assumed to span 360 degrees
+        self._lat_offset = float(self.lat[0])
+        self._lat_scale = (len(self.lat) - 1) / float(self.lat[0] - self.lat[-1])
+        self._lon_offset = float(self.lon[0])
+        self._lon_scale = len(self.lon) / 360.0
+
+        # lookup table from time to fractional index, also valid for non-uniform time steps
+        self._t_points = np.asarray(self.t, dtype=np.float64)
+        self._t_idx = np.arange(len(self._t_points), dtype=np.float64)
+
         if self.cubes[0].coords('ensemble_member'):
             self.ens = self.cubes[0].coord('ensemble_member').points
-            self.north_mean = self.cubes[0].collapsed('ensemble_member', iris.analysis.MEAN).data
-            self.east_mean = self.cubes[1].collapsed('ensemble_member', iris.analysis.MEAN).data
+            self.wind_mean = np.ascontiguousarray(
+                np.stack([self.cubes[0].collapsed('ensemble_member', iris.analysis.MEAN).data,
+                          self.cubes[1].collapsed('ensemble_member', iris.analysis.MEAN).data], axis=-1),
+                dtype=np.float32)
         else:
             self.ens = []
-            self.north = self.cubes[0].data
-            self.east = self.cubes[1].data
-        self.__ens = []
+            self.wind = np.ascontiguousarray(np.stack([self.cubes[0].data, self.cubes[1].data], axis=-1),
+                                             dtype=np.float32)
+        self._has_ens = len(self.ens) > 0
+        self._ensembles = self.ens if self._has_ens else np.array([1])
+        self._time = num2date(self.t, units='hours since 1900-01-01 00:00:0.0', calendar='gregorian')
+        self.__ens = None
         self.__load_ensemble(ensemble)
 
+        # compile the kernels now, so the first simulation step does not stall
+        isa_pressure(np.zeros(1))
+        self.__interpolate(self.wind, self.lat[:1], self.lon[:1], self._pres_xp[:1], self._t_points[0])
+
         self.__loaded = True
 
     # -----  mimic windsim class API -------------------
@@ -153,10 +205,40 @@ class WindIris:
         east: array_like
             East component of the wind.
          """
-        p = vatmos(useralt)[0]
-        time = bs.sim.utc
+        return self.get_batch(userlat, userlon, useralt)
 
-        return self._get_wind(userlat, userlon, p, time)
+    def get_batch(self, lat, lon, alt, time=None):
+        """ Retrieve the north and east component of the windfield for a batch of positions in one
+        vectorised call.
+
+        Parameters
+        ----------
+        lat : array_like
+            Latitudes [deg]
+        lon : array_like
+            Longitudes [deg]
+        alt : array_like
+            Altitudes [m]
+        time : datetime, optional
+            Timestamp, defaults to the current simulation time.
+
+        Returns
+        -------
+        north: array_like
+             North component of the wind.
+        east: array_like
+            East component of the wind.
+        """
+        if not self.__loaded:
+            # No wind file loaded: skip the pressure conversion, as _get_wind returns no wind
+            return 0, 0
+
+        lat, lon, alt = np.broadcast_arrays(*np.atleast_1d(lat, lon, alt))
+        p = isa_pressure(np.ascontiguousarray(alt, dtype=np.float64))
+        if time is None:
+            time = bs.sim.utc
+
+        return self._get_wind(lat, lon, p, time)
 
     def addpoint(self, lat, lon, winddir, windspd, windalt=None):
         # not used
@@ -176,44 +258,40 @@ class WindIris:
 
     @property
     def ensembles(self):
-        if self.ens.any():
-            return self.cubes[0].coord('ensemble_member').points
-        else:
-            return [1]
+        return self._ensembles
 
     @property
     def time(self):
         """Time instance of forecast in hours since 1900-01-01 00:00:0.0"""
-        return num2date(self.cubes[0].coord('time').points, units='hours since 1900-01-01 00:00:0.0',
-                        calendar='gregorian')
+        return self._time
 
     def __load_ensemble(self, ens):
         # check if cubes contains ensemble members
-        if list(self.ens):
+        if self._has_ens:
             # if ens member is different from the one currently loaded
-            if self.__ens is not ens:
-                self.north = self.cubes[0].extract(iris.Constraint(ensemble_member=ens)).data - self.north_mean
-                self.east = self.cubes[1].extract(iris.Constraint(ensemble_member=ens)).data - self.east_mean
+            if self.__ens is None or self.__ens != ens:
+                self.wind = np.ascontiguousarray(
+                    np.stack([self.cubes[0].extract(iris.Constraint(ensemble_member=ens)).data,
+                              self.cubes[1].extract(iris.Constraint(ensemble_member=ens)).data], axis=-1)
+                    - self.wind_mean, dtype=np.float32)
             self.__ens = ens
 
-    def __interpolate(self, cube_n, cube_e, lat, lon, pressure, time):
-        # wrap longitude around for periodic boundary
-        lon = (lon + 360) % 360
-
-        # saturate pressure altitude
-        pressure = np.clip(pressure, self.pressure[0], self.pressure[-1])
-
-        # find coordinates, assumes 720/360 grid size TODO change to be more flexible
-        lon_i = lon * (720 / 360)
-        lat_i = (lat - 90) * (360 / -180)
-
-        f = interpolate.interp1d(self.pressure, range(len(self.pressure)), bounds_error=True, assume_sorted=True)
-        pres_i = f(pressure)
-        time_i = (time - self.cubes[0].coord('time').points[0]) / len(self.cubes[0].coord('time').points)
-
-        # TODO check for out of bounds
-        coord = np.vstack((time_i, pres_i, lat_i, lon_i))
-
-        north = ndimage.map_coordinates(cube_n, coord, order=1, mode='wrap')
-        east = ndimage.map_coordinates(cube_e, coord, order=1, mode='wrap')
-        return north, east
+    def __interpolate(self, cube, lat, lon, pressure, time):
+        lat, lon, pressure = np.broadcast_arrays(*np.atleast_1d(lat, lon, pressure))
+        n = lat.shape[0]
+        if n > self._coord_buf.shape[1]:
+            self._coord_buf = np.empty((4, max(n, 2 * self._coord_buf.shape[1])))
+        time_i, pres_i, lat_i, lon_i = self._coord_buf[:, :n]
+
+        # find grid coordinates, wrapping of longitude and saturation of the
+        # other axes is done in the kernel, np.interp saturates the pressure
+        np.subtract(lon, self._lon_offset, out=lon_i)
+        np.multiply(lon_i, self._lon_scale, out=lon_i)
+        np.subtract(self._lat_offset, lat, out=lat_i)
+        np.multiply(lat_i, self._lat_scale, out=lat_i)
+
+        pres_i[:] = np.interp(pressure, self._pres_xp, self._pres_idx)
+        time_i[:] = np.interp(time, self._t_points, self._t_idx)
+
+        wind = interp4d_linear_wrap(cube, time_i, pres_i, lat_i, lon_i)
+        return wind[:, 0], wind[:, 1]
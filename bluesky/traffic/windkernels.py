@@ -0,0 +1,131 @@
+""" Compiled interpolation kernels for the netCDF wind field (WindIris).
+
+Uses numba when available; otherwise vectorised scipy/numpy versions of the
+kernels are used. njit and HAVE_NUMBA are also used by plugins with their own
+kernels, which then run as plain Python without numba.
+"""
+import math
+import numpy as np
+from bluesky.tools.aero import R, T0, Tstrat, beta, rho0
+
+try:
+    from numba import njit
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+    print("Could not import numba, wind and AFMS kernels run as plain Python")
+
+    def njit(*args, **kwargs):
+        """ Stand-in for numba.njit that returns the function unchanged. """
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda fun: fun
+
+
+@njit(cache=True, error_model='numpy')
+def isa_atmos(h):
+    """ ISA pressure [Pa], density [kg/m3] and temperature [K] at a single altitude h [m], as aero.vatmos. """
+    T = max(T0 + beta * h, Tstrat)
+    rho = rho0 * (T / T0) ** 4.256848030018761 * math.exp(-max(0., h - 11000.) / 6341.552161)
+    return rho * R * T, rho, T
+
+
+if HAVE_NUMBA:
+    @njit(cache=True, fastmath=True)
+    def isa_pressure(h):
+        """ ISA pressure [Pa] for a 1D array of altitudes h [m], as aero.vatmos. """
+        p = np.empty(h.shape[0])
+        for k in range(h.shape[0]):
+            p[k] = isa_atmos(h[k])[0]
+        return p
+
+
+    @njit(cache=True)
+    def _clamped_axis(x, n):
+        """ Lower/upper grid index and weight of fractional index x on a
+            non-periodic axis of length n (saturated at the edges). """
+        if n < 2:
+            return 0, 0, 0.0
+        x = min(max(x, 0.0), n - 1.0)
+        i0 = min(int(x), n - 2)
+        return i0, i0 + 1, x - i0
+
+
+    @njit(cache=True, fastmath=True)
+    def interp4d_linear_wrap(cube, t, p, lat, lon):
+        """ Linear interpolation in a (time, pressure, lat, lon, component) cube.
+
+        All components are interpolated in the same pass, so the 16 corner
+        cells of each coordinate are visited only once.
+
+        Parameters
+        ----------
+        cube : ndarray
+            5D data cube, the last axis holds the components (e.g. north, east).
+        t, p, lat, lon : ndarray
+            1D arrays with fractional indices along each axis of the cube.
+            The longitude axis is periodic, all other axes are saturated.
+
+        Returns
+        -------
+        values : ndarray
+            Interpolated values with shape (ncoord, ncomponent).
+        """
+        nt, npres, nlat, nlon, ncomp = cube.shape
+        out = np.zeros((t.shape[0], ncomp))
+        for k in range(t.shape[0]):
+            t0, t1, ft = _clamped_axis(t[k], nt)
+            p0, p1, fp = _clamped_axis(p[k], npres)
+            a0, a1, fa = _clamped_axis(lat[k], nlat)
+
+            x = lon[k] - math.floor(lon[k] / nlon) * nlon
+            o0 = int(x)
+            fo = x - o0
+            o0 = o0 % nlon
+            o1 = (o0 + 1) % nlon
+
+            ti = (t0, t1)
+            tw = (1.0 - ft, ft)
+            pi = (p0, p1)
+            pw = (1.0 - fp, fp)
+            ai = (a0, a1)
+            aw = (1.0 - fa, fa)
+            oi = (o0, o1)
+            ow = (1.0 - fo, fo)
+
+            for i in range(2):
+                for j in range(2):
+                    wij = tw[i] * pw[j]
+                    for m in range(2):
+                        wijm = wij * aw[m]
+                        for n in range(2):
+                            w = wijm * ow[n]
+                            cell = cube[ti[i], pi[j], ai[m], oi[n]]
+                            for c in range(ncomp):
+                                out[k, c] += w * cell[c]
+        return out
+
+else:
+    # As plain Python the loops above would be orders of magnitude slower
+    # than these vectorised versions
+    from scipy import ndimage
+    from bluesky.tools.aero import vatmos
+
+    def isa_pressure(h):
+        """ ISA pressure [Pa] for a 1D array of altitudes h [m], as aero.vatmos. """
+        return vatmos(h)[0]
+
+    def interp4d_linear_wrap(cube, t, p, lat, lon):
+        """ Linear interpolation in a (time, pressure, lat, lon, component) cube,
+            see the compiled version above. """
+        nt, npres, nlat, nlon, ncomp = cube.shape
+        coord = np.empty((4, t.shape[0]))
+        # Saturate the non-periodic axes here, so 'grid-wrap' only wraps the longitude
+        np.clip(t, 0.0, nt - 1.0, out=coord[0])
+        np.clip(p, 0.0, npres - 1.0, out=coord[1])
+        np.clip(lat, 0.0, nlat - 1.0, out=coord[2])
+        np.mod(lon, nlon, out=coord[3])
+        out = np.empty((t.shape[0], ncomp))
+        for c in range(ncomp):
+            ndimage.map_coordinates(cube[..., c], coord, output=out[:, c], order=1, mode='grid-wrap')
+        return out
@@ -1,52 +1,77 @@
 """ BlueSky plugin for logging ac data. """
 
 from bluesky import stack, traf, sim
-import pandas as pd
-import pickle as p
+import numpy as np
 
 
 class Logger:
+    columns = ['time', 'lat', 'lon', 'alt', 'heading', 'gs', 'M', 'tas', 'mass']
+
     def __init__(self):
-        self.acid = []
-        self.data = {}
+        self.acid = {}  # logged acids with their cached traffic index
+        self.data = {}  # per acid a (capacity, len(columns)) buffer, grown by doubling
+        self.nrows = {}  # number of rows in use per acid
         self.enable = False
+        self._update = self._update_off  # per-tick step, switched by toggle()
 
     def log(self, acid, flag):
         # find if acid exists
-        if acid not in traf.id:
+        idx = traf.id2idx(acid)
+        if idx < 0:
             raise ValueError('acid not found')
 
         # Enable or disable logging for acid
         if flag is True:
-            self.acid.append(acid)
-            self.data[acid] = []
+            self.acid[acid] = idx
+            self.data[acid] = np.empty((64, len(self.columns)))
+            self.nrows[acid] = 0
         if flag is False:
-            if acid in self.acid:
-                self.acid.remove(acid)
-            else:
+            if self.acid.pop(acid, None) is None:
                 print("Cannot remove acid, not added.")
 
     def update(self):
-        if self.enable:
-            for ac in self.acid:
-                idx = traf.id2idx(ac)
-                self.data[ac].append([sim.simt, traf.lat[idx], traf.lon[idx], traf.alt[idx], traf.hdg[idx],
-                                      traf.gs[idx], traf.M[idx], traf.tas[idx], traf.perf.mass])
+        self._update()
+
+    def _update_off(self):
+        pass
+
+    def _update_on(self):
+        if self.acid:
+            # indices shift when aircraft are deleted, look up again when stale
+            for ac, idx in self.acid.items():
+                if idx < 0 or idx >= traf.ntraf or traf.id[idx] != ac:
+                    self.acid[ac] = traf.id2idx(ac)
+
+            acids = [ac for ac, idx in self.acid.items() if idx >= 0]
+            idxs = np.fromiter((self.acid[ac] for ac in acids), dtype=np.intp, count=len(acids))
+            rows = np.column_stack([np.full(len(idxs), sim.simt), traf.lat[idxs], traf.lon[idxs],
+                                    traf.alt[idxs], traf.hdg[idxs], traf.gs[idxs], traf.M[idxs],
+                                    traf.tas[idxs], traf.perf.mass[idxs]])
+            for ac, row in zip(acids, rows):
+                self._append(ac, row)
+
+    def _append(self, acid, row):
+        buf = self.data[acid]
+        n = self.nrows[acid]
+        if n == len(buf):
+            buf = self.data[acid] = np.concatenate((buf, np.empty_like(buf)))
+        buf[n] = row
+        self.nrows[acid] = n + 1
 
     def preupdate(self):
         pass
 
     def reset(self):
-        self.acid = []
+        self.acid = {}
         self.data = {}
+        self.nrows = {}
         self.enable = False
+        self._update = self._update_off
 
     def save(self):
-        results = {}
-        for ac in self.acid:
-            df = pd.DataFrame(self.data[ac], columns=['time', 'lat', 'lon', 'alt', 'heading', 'gs', 'M', 'tas', 'mass'])
-            results[ac] = df
-        p.dump(results, open("output/data.p", "wb"))
+        """ Store the logged data as one (nrows, len(columns)) array per acid in output/data.npz """
+        results = {ac: self.data[ac][:self.nrows[ac]] for ac in self.acid}
+        np.savez_compressed("output/data.npz", columns=np.array(self.columns), **results)
 
 
 logger = Logger()
@@ -129,3 +154,4 @@ def toggle(flag):
     if logger.enable is True and flag is False:  # switch off
         logger.save()
     logger.enable = flag
+    logger._update = logger._update_on if flag else logger._update_off
@@ -1,17 +1,191 @@
 """ Flight Management System Mode plugin """
 # Import the global bluesky objects. Uncomment the ones you need
-from datetime import date, datetime, time, timedelta
-from math import sqrt
+import math
 import numpy as np
 
-from bluesky import sim, stack, traf, tools  #, settings, navdb, sim, scr, tools
+from bluesky import sim, traf, tools  #, settings, navdb, sim, scr, tools
+from bluesky.tools.aero import nm, p0, rho0
+from bluesky.traffic import autopilot
 from bluesky.traffic.route import Route
 from bluesky.traffic.performance.legacy.performance import PHASE
+from bluesky.traffic.windkernels import isa_atmos, njit
 # import inspect  # TODO Remove after test
 
 # Global data
 afms = None
 
+
+def _seconds_of_day(t):
+    """ Whole seconds since midnight of a datetime.time """
+    return t.hour * 3600 + t.minute * 60 + t.second
+
+
+def _hms2seconds(txt):
+    """ Whole seconds since midnight of a 'HH:MM:SS' string, without going through strptime """
+    hh, mm, ss = (int(part) for part in txt.split(':'))
+    if not (0 <= hh < 24 and 0 <= mm < 60 and 0 <= ss < 60):
+        raise ValueError("time data '" + txt + "' does not match format 'HH:MM:SS'")
+    return hh * 3600 + mm * 60 + ss
+
+
+@njit(cache=True, fastmath=True)
+def _rta_spd(distance_nm, time_s, current_tas_m_s):
+    """
+    TAS to reach after a single acceleration/deceleration to cover the distance in the given time
+    :param distance_nm: distance in nm
+    :param time_s: time in seconds
+    :param current_tas_m_s: current TAS in m/s
+    :return: TAS in m/s
+    """
+    acceleration_m_s2 = 1.94  # See standard coefficients for Bluesky
+    deceleration_m_s2 = -1.265
+    distance_m = distance_nm * nm
+    if time_s > 60:  # TODO From which time before it is not usefull anymore to change the speed?
+        if distance_m / time_s > current_tas_m_s:
+            #Acceleration
+            a = acceleration_m_s2
+        else:
+            #Deceleration
+            a = deceleration_m_s2
+        discriminant = a*a*time_s*time_s + 2*a*current_tas_m_s*time_s - 2*a*distance_m
+        t1_s = 0.0 if discriminant < 0.0 else time_s - 1/a * math.sqrt(discriminant)
+        if t1_s > time_s:
+            tas2_m_s = current_tas_m_s + a*time_s
+        else:
+            tas2_m_s = current_tas_m_s + a * t1_s
+    else:
+        tas2_m_s = current_tas_m_s
+
+    return tas2_m_s  # TODO Do I need a speed limiter, or just let Bluesky handle this?
+
+
+@njit(cache=True, fastmath=True)
+def _eta_preferred_spd(distance_nm, current_tas_m_s, preferred_tas_m_s):
+    """
+    Time to cover the distance when changing from the current to the preferred TAS
+    :param distance_nm: distance in nm
+    :param current_tas_m_s: current TAS in m/s
+    :param preferred_tas_m_s: preferred TAS in m/s
+    :return: time in seconds
+    """
+    acceleration_m_s2 = 1.94  # See standard coefficients for Bluesky
+    deceleration_m_s2 = -1.265
+    distance_m = distance_nm * nm
+    if preferred_tas_m_s > current_tas_m_s:
+        #Acceleration
+        a = acceleration_m_s2
+    else:
+        #Deceleration
+        a = deceleration_m_s2
+    t2_s = (distance_m - 1 / (2 * a) * (preferred_tas_m_s ** 2 - current_tas_m_s ** 2)) / preferred_tas_m_s
+    if t2_s < 0:
+        return 0.0
+    else:
+        return t2_s
+
+
+@njit(cache=True, error_model='numpy')
+def _cas2tas(cas, p, rho):
+    """ Scalar version of aero.vcas2tas, cas in m/s, with pressure and density from isa_atmos """
+    qdyn = p0 * ((1. + rho0 * cas * cas / (7. * p0)) ** 3.5 - 1.)
+    tas = math.sqrt(7. * p / rho * ((1. + qdyn / p) ** (2. / 7.) - 1.))
+    return -tas if cas < 0 else tas
+
+
+@njit(cache=True, error_model='numpy')
+def _rta_cas_wfl(distances_m, flightlevels, time_s, current_cas_m_s):
+    """
+    CAS needed to arrive at the RTA waypoint in the specified time, see Afms._rta_cas_wfl
+    :param distances_m: distances between waypoints in m
+    :param flightlevels: flightlevels for sections in m
+    :param time_s: time in seconds to RTA waypoint
+    :param current_cas_m_s: current CAS in m/s
+    :return: CAS in m/s
+    """
+    acceleration_m_s2 = 1.94/2  # See standard coefficients for Bluesky
+    deceleration_m_s2 = -1.265/2
+    iterations = 3
+    estimated_cas_m_s = current_cas_m_s
+    cas_rta_m_s = current_cas_m_s
+
+    # The atmosphere per section does not change between iterations
+    n = distances_m.shape[0]
+    p = np.empty(n)
+    rho = np.empty(n)
+    previous_fl_m = flightlevels[0]
+    for i in range(n):
+        if flightlevels[i] < 0:
+            next_fl = previous_fl_m
+        else:
+            next_fl = flightlevels[i]
+        p[i], rho[i], _ = isa_atmos(next_fl)
+    current_tas_m_s = _cas2tas(current_cas_m_s, p[0], rho[0])
+
+    for it in range(iterations):
+        # First section, including the speed change from the current CAS
+        next_tas_m_s = _cas2tas(estimated_cas_m_s, p[0], rho[0])
+        if estimated_cas_m_s > current_cas_m_s + 1.0:
+            #Accelerate
+            a = acceleration_m_s2
+            delta_time_s = (next_tas_m_s - current_tas_m_s) / a
+            delta_dist_m = 0.5 * a * delta_time_s ** 2 + current_tas_m_s * delta_time_s
+        elif estimated_cas_m_s < current_cas_m_s - 1.0:
+            #Decelerate
+            a = deceleration_m_s2
+            delta_time_s = (-next_tas_m_s + current_tas_m_s) / a
+            delta_dist_m = 0.5 * a * delta_time_s ** 2 + current_tas_m_s * delta_time_s
+        else:
+            # No speed change
+            delta_time_s = 0.0
+            delta_dist_m = 0.0
+        total_time_s = (distances_m[0] - delta_dist_m) / next_tas_m_s + delta_time_s
+
+        # Remaining sections are flown at the estimated CAS, without branches
+        for i in range(1, n):
+            total_time_s += distances_m[i] / _cas2tas(estimated_cas_m_s, p[i], rho[i])
+
+        cas_rta_m_s = estimated_cas_m_s
+        estimated_cas_m_s = cas_rta_m_s * total_time_s / time_s
+    return cas_rta_m_s
+
+
+@njit(cache=True, error_model='numpy')
+def _eta_wfl(distances, flightlevels, cas_m_s):
+    """
+    Flight time at a constant CAS, see Afms._eta_wfl; no temporary arrays are allocated
+    :param distances: distances between waypoints in nm
+    :param flightlevels: flightlevels for sections in m
+    :param cas_m_s: CAS in m/s
+    :return: time in seconds
+    """
+    total_time_s = 0.
+    for i in range(distances.shape[0]):
+        # Sections without a flightlevel are flown at the first flightlevel
+        fl = flightlevels[0] if flightlevels[i] < 0 else flightlevels[i]
+        p, rho, _ = isa_atmos(fl)
+        total_time_s += distances[i] * nm / _cas2tas(cas_m_s, p, rho)
+    return total_time_s
+
+
+@njit(cache=True, error_model='numpy')
+def _rta_cas_wfl_batch(distances_m, flightlevels, nsections, time_s, current_cas_m_s):
+    """
+    _rta_cas_wfl for a batch of aircraft with padded route segments
+    :param distances_m: distances between waypoints in m, one row per aircraft
+    :param flightlevels: flightlevels for sections in m, one row per aircraft
+    :param nsections: number of valid sections per row (0: not solved, CAS is NaN)
+    :param time_s: time in seconds to RTA waypoint per aircraft
+    :param current_cas_m_s: current CAS in m/s per aircraft
+    :return: CAS in m/s per aircraft
+    """
+    cas_m_s = np.full(nsections.shape[0], np.nan)
+    for k in range(nsections.shape[0]):
+        n = nsections[k]
+        if n > 0:
+            cas_m_s[k] = _rta_cas_wfl(distances_m[k, :n], flightlevels[k, :n], time_s[k], current_cas_m_s[k])
+    return cas_m_s
+
+
 def init_plugin():
 
     # Additional initilisation code
@@ -127,6 +301,119 @@ def init_plugin():
 ### Periodic update functions that are called by the simulation. You can replace
 ### this by anything, so long as you communicate this in init_plugin
 
+class AfmsRoute(Route):
+    """
+    Route with the additional waypoint data needed for AFMS.
+    These include wprta, wprta_window_size, wpfms_mode, and wpown.
+    wprta indicates the rta time in seconds of the day (NaN if no rta)
+    wprta_window_size gives the time window size in seconds
+    wpfms_mode gives the used afms mode
+    wpown gives the preferred speed (Mach or CAS in m/s)
+    """
+    rta_standard_window_size = 60.  # [s] standard time window size for rta in seconds
+
+    def __init__(self):
+        super(AfmsRoute, self).__init__()
+        self.wprta = np.array([])  # [s] Required Time of Arrival to WPT in seconds of the day, NaN if no rta
+        self.wprta_window_size = np.array([], dtype=np.float32)  # [s] Window size around RTA
+        self.wpfms_mode = np.array([], dtype=np.int8)  # Advanced FMS mode
+        self.wpown = np.array([])  # Own speed for TW/OWN Advanced FMS mode
+        self.wpname_idx = None  # Waypoint name -> index, rebuilt on first lookup after a route change
+        self._afms_reset()
+
+    def _afms_reset(self):
+        """ Restart the search for the active AFMS mode and own speed """
+        self.afms_scanned = 0  # number of waypoints searched for the active AFMS mode and own speed
+        self.afms_mode = 0  # active AFMS mode, OFF until set at a passed waypoint
+        self.afms_own = -1.  # active own speed, -1 if not specified
+
+    def afms_changed(self, wpidx):
+        """ Call when the AFMS mode or own speed of waypoint wpidx is changed """
+        if wpidx < self.afms_scanned:
+            self._afms_reset()
+
+    def afms_active(self):
+        """
+        Active AFMS mode and own speed: the last ones set before the active waypoint.
+        Only waypoints passed since the previous call are searched.
+        :return: fms mode, own speed (Mach or CAS in m/s, -1 if not specified)
+        """
+        nscan = self.wpfms_mode[:self.iactwp].size
+        if nscan < self.afms_scanned:
+            # Active waypoint moved back (e.g. DIRECT)
+            self._afms_reset()
+        if nscan > self.afms_scanned:
+            wpfms_mode = self.wpfms_mode[self.afms_scanned:nscan]
+            fms_mode_index = np.flatnonzero(wpfms_mode != 1)
+            if fms_mode_index.size:
+                self.afms_mode = int(wpfms_mode[fms_mode_index[-1]])
+            wpown = self.wpown[self.afms_scanned:nscan]
+            own_spd_index = np.flatnonzero(wpown >= 0)
+            if own_spd_index.size:
+                self.afms_own = float(wpown[own_spd_index[-1]])
+            self.afms_scanned = nscan
+        return self.afms_mode, self.afms_own
+
+    def set_rta(self, wpidx, rta_s):
+        """ Set the RTA of waypoint wpidx [seconds of the day] """
+        self.wprta[wpidx] = rta_s
+
+    def next_rta(self, wpidx):
+        """
+        Find the first waypoint with an RTA, starting at waypoint wpidx
+        :return: waypoint index, -1 if there is no such waypoint
+        """
+        start = max(wpidx, 0)
+        rta = self.wprta[start:]
+        if rta.size == 0:
+            return -1
+        has_rta = ~np.isnan(rta)
+        k = int(has_rta.argmax())
+        return start + k if has_rta[k] else -1
+
+    def wp_index(self, name):
+        """
+        Look up a waypoint by name
+        :param name: waypoint name
+        :return: index of the first waypoint with this name, -1 if not in route
+        """
+        if self.wpname_idx is not None:
+            wpidx = self.wpname_idx.get(name, -1)
+            if wpidx > -1 and wpidx < len(self.wpname) and self.wpname[wpidx] == name:
+                return wpidx
+        # Build the lookup, also when waypoints were inserted without addwpt_data (e.g. T/C, T/D)
+        self.wpname_idx = {}
+        for i, wpname in enumerate(self.wpname):
+            self.wpname_idx.setdefault(wpname, i)
+        return self.wpname_idx.get(name, -1)
+
+    def addwpt_data(self, overwrt, wpidx, wpname, wplat, wplon, wptype,
+                    wpalt, wpspd, swflyby):
+        super(AfmsRoute, self).addwpt_data(overwrt, wpidx, wpname, wplat, wplon, wptype,
+                                           wpalt, wpspd, swflyby)
+        self.wpname_idx = None
+        self._afms_reset()
+        if overwrt:
+            self.wprta[wpidx] = np.nan  # NaN indicates no rta
+            self.wprta_window_size[wpidx] = self.rta_standard_window_size
+            self.wpfms_mode[wpidx] = 1  # Set advanced FMS mode to continue
+            self.wpown[wpidx] = -1  # Set own spd index to use previous setting
+        else:
+            self.wprta = np.insert(self.wprta, wpidx, np.nan)  # NaN indicates no rta
+            self.wprta_window_size = np.insert(self.wprta_window_size, wpidx, self.rta_standard_window_size)
+            self.wpfms_mode = np.insert(self.wpfms_mode, wpidx, 1)  # Set advanced FMS mode to continue
+            self.wpown = np.insert(self.wpown, wpidx, -1)  # Set own speed index to use previous own speed setting
+
+    def _del_wpt_data(self, idx):
+        super(AfmsRoute, self)._del_wpt_data(idx)
+        self.wpname_idx = None
+        self._afms_reset()
+        self.wprta = np.delete(self.wprta, idx)
+        self.wprta_window_size = np.delete(self.wprta_window_size, idx)
+        self.wpfms_mode = np.delete(self.wpfms_mode, idx)
+        self.wpown = np.delete(self.wpown, idx)
+
+
 class Afms:
     """ Advanced FMS: dynamically adjust speed of flights based on set AFMS mode and/or RTA/Time Window"""
     def __init__(self):
@@ -135,58 +422,12 @@ class Afms:
         self.dt = 60.0  # [s] frequency of afms update (simtime)
         self.skip2next_rta_time_s = 120.0  # Time when skipping to the RTA beyond the active RTA
         self.rta_standard_window_size = 60.  # [s] standard time window size for rta in seconds
-        self._patch_route(self.rta_standard_window_size)
+        AfmsRoute.rta_standard_window_size = self.rta_standard_window_size
+        autopilot.Route = AfmsRoute  # New aircraft get a route with AFMS data
         self._fms_modes = ['OFF', 'CONTINUE', 'OWN', 'RTA', 'TW']
-
-    @staticmethod
-    def _patch_route(rta_standard_window_size):
-        """
-        Patch the route class to allow for new data types needed for AFMS.
-        These include wprta, wprta_window_size, wpfms_mode, and wpown.
-        wprta indicates the rta time
-        wprta_window_size gives the time window size in seconds
-        wpfms_mode gives the used afms mode
-        wpown gives the preferred speed (Mach or CAS in m/s)
-        """
-        Route._rta_standard_window_size = rta_standard_window_size
-        old_route_init = Route.__init__
-
-        def new_route_init(self, *k, **kw):
-            old_route_init(self, *k, **kw)
-            self.wprta = []  # [s] Required Time of Arrival to WPT
-            self.wprta_window_size = []  # [s] Window size around RTA
-            self.wpfms_mode = []  # Advanced FMS mode
-            self.wpown = []  # Own speed for TW/OWN Advanced FMS mode
-
-        Route.__init__ = new_route_init
-
-        old_route_addwpt_data = Route.addwpt_data
-
-        def new_route_addwpt_data(self, overwrt, wpidx, *k, **kw):
-            old_route_addwpt_data(self, overwrt, wpidx, *k, **kw)
-            if overwrt:
-                self.wprta[wpidx] = -1.  # negative indicates no rta
-                self.wprta_window_size[wpidx] = Route._rta_standard_window_size
-                self.wpfms_mode[wpidx] = 1  # Set advanced FMS mode to continue
-                self.wpown[wpidx] = -1  # Set own spd index to use previous setting
-            else:
-                self.wprta.insert(wpidx, -1.)  # negative indicates no rta
-                self.wprta_window_size.insert(wpidx, Route._rta_standard_window_size)
-                self.wpfms_mode.insert(wpidx, 1)  # Set advanced FMS mode to continue
-                self.wpown.insert(wpidx, -1)  # Set own speed index to use previous own speed setting
-
-        Route.addwpt_data = new_route_addwpt_data
-
-        old_route_del_wpt_data = Route._del_wpt_data
-
-        def new_del_wpt_data(self, wpidx):
-            old_route_del_wpt_data(self, wpidx)
-            del self.wprta[wpidx]
-            del self.wprta_window_size[wpidx]
-            del self.wpfms_mode[wpidx]
-            del self.wpown[wpidx]
-
-        Route._del_wpt_data = new_del_wpt_data
+        self._scratch = np.empty((3, 256))  # fms mode, active waypoint lat/lon; reused every preupdate
+        self._segment_buf = np.empty((2, 64))  # distances, flightlevels of the route segment to the RTA
+        self._any_afms_active = False  # True once an AFMS mode has been set on any route
 
     def update(self):
         pass
@@ -195,106 +436,178 @@ class Afms:
         """
         update the AFMS mode settings before the traffic is updated.
         """
-        for idx, _ in enumerate(traf.id):
-            fms_mode = self._current_fms_mode(idx)
-            if int(traf.perf.phase[idx]) == PHASE['CR']:
-                if fms_mode == 0:  # AFMS_MODE OFF
-                    pass
-                elif fms_mode == 1:  # AFMS_MODE CONTINUE
-                    pass
-                elif fms_mode == 2:  # AFMS_MODE OWN
-                    own_spd = self._current_own_spd(idx)
-                    if own_spd < 0:
-                        print('No own speed specified')
-                    elif own_spd < 1:
-                        stack.stack(f'SPD {traf.id[idx]}, {own_spd}')
-                        stack.stack(f'VNAV {traf.id[idx]} ON')
-                    else:
-                        stack.stack(f'SPD {traf.id[idx]}, {own_spd * 3600 / 1852}')
-                        stack.stack(f'VNAV {traf.id[idx]} ON')
-                elif fms_mode == 3:  # AFMS_MODE RTA
-                    rta_init_index, rta_last_index, rta = self._current_rta(idx)
-                    time_s2rta = self._time_s2rta(rta)
-                    if time_s2rta < self.skip2next_rta_time_s:
-                        rta_init_index, rta_last_index, rta = self._current_rta_plus_one(idx)
-                        time_s2rta = self._time_s2rta(rta)
-                    else:
-                        pass
-
-                    _, dist2nwp = tools.geo.qdrdist(traf.lat[idx], traf.lon[idx],
-                                                    traf.ap.route[idx].wplat[rta_init_index],
-                                                    traf.ap.route[idx].wplon[rta_init_index])
-                    distances = np.concatenate((np.array([dist2nwp]),
-                                                traf.ap.route[idx].wpdistto[rta_init_index + 1:rta_last_index + 1]),
-                                               axis=0)
-                    flightlevels = np.concatenate((np.array([traf.alt[idx]]),
-                                                   traf.ap.route[idx].wpalt[rta_init_index + 1:rta_last_index + 1]))
-                    rta_cas_kts = self._rta_cas_wfl(distances, flightlevels, time_s2rta, traf.cas[idx]) * 3600 / 1852
-
-                    stack.stack(f'SPD {traf.id[idx]}, {rta_cas_kts}')
-                    stack.stack(f'VNAV {traf.id[idx]} ON')
-                elif fms_mode == 4:  # AFMS_MODE TW
-                    rta_init_index, rta_last_index, rta = self._current_rta(idx)
-                    tw_init_index, tw_last_index, tw_size = self._current_tw_size(idx)
-                    _, dist2nwp = tools.geo.qdrdist(traf.lat[idx], traf.lon[idx],
-                                                    traf.ap.route[idx].wplat[rta_init_index],
-                                                    traf.ap.route[idx].wplon[rta_init_index])
-
-                    distances = np.concatenate((np.array([dist2nwp]),
-                                                traf.ap.route[idx].wpdistto[rta_init_index + 1:rta_last_index + 1]),
-                                               axis=0)
-                    flightlevels = np.concatenate((np.array([traf.alt[idx]]),
-                                                   traf.ap.route[idx].wpalt[rta_init_index + 1:rta_last_index + 1]))
-
-                    own_spd = self._current_own_spd(idx)
-                    if own_spd < 0:
-                        # No speed specified. Use current speed
-                        preferred_cas_m_s = traf.cas[idx]
-                    elif own_spd < 1:
-                        # Mach speed specified
-                        preferred_cas_m_s = tools.aero.vmach2cas(own_spd, traf.alt[idx])
-                    else:
-                        # CAS specified
-                        preferred_cas_m_s = own_spd
-
-                    eta_s_preferred = self._eta_wfl(distances, flightlevels, preferred_cas_m_s)
-                    time_s2rta = self._time_s2rta(rta)
-                    if eta_s_preferred < self.skip2next_rta_time_s:
-                        rta_init_index, rta_last_index, rta = self._current_rta_plus_one(idx)
-                        time_s2rta = self._time_s2rta(rta)
-                        _, dist2nwp = tools.geo.qdrdist(traf.lat[idx], traf.lon[idx],
-                                                        traf.ap.route[idx].wplat[rta_init_index],
-                                                        traf.ap.route[idx].wplon[rta_init_index])
-
-                        distances = np.concatenate((np.array([dist2nwp]),
-                                                    traf.ap.route[idx].wpdistto[rta_init_index + 1:rta_last_index + 1]),
-                                                   axis=0)
-                        flightlevels = np.concatenate((np.array([traf.alt[idx]]),
-                                                       traf.ap.route[idx].wpalt[rta_init_index + 1:rta_last_index + 1]))
-
-                        eta_s_preferred = self._eta_wfl(distances, flightlevels, preferred_cas_m_s)
-                    else:
-                        pass
-                    earliest_time_s2rta = time_s2rta - tw_size/2
-                    latest_time_s2rta = time_s2rta + tw_size/2
-                    if eta_s_preferred < earliest_time_s2rta:
-                        time_window_cas_kts = self._rta_cas_wfl(distances, flightlevels, earliest_time_s2rta,
-                                                        traf.cas[idx]) * 3600 / 1852
-                    elif eta_s_preferred > latest_time_s2rta:
-                        time_window_cas_kts = self._rta_cas_wfl(distances, flightlevels, latest_time_s2rta,
-                                                        traf.cas[idx]) * 3600 / 1852
-                    else:
-                        time_window_cas_kts = preferred_cas_m_s * 3600 / 1852
-
-                    stack.stack(f'SPD {traf.id[idx]}, {time_window_cas_kts}')
-                    stack.stack(f'VNAV {traf.id[idx]} ON')
-                else:
-                    return False, 'AFMS mode does not exist' + traf.id[idx]
+        if not self._any_afms_active:
+            # Without an AFMS mode every aircraft is OFF/CONTINUE, and nothing needs to be done
+            return
+        # Gather the cruising aircraft and split them by active AFMS mode; phases are whole numbers,
+        # so no integer copy of the phase array is needed, and other aircraft are never scanned
+        cruise = np.flatnonzero(traf.perf.phase == PHASE['CR'])
+        if cruise.size == 0:
+            return
+        routes = traf.ap.route
+        if cruise.size > self._scratch.shape[1]:
+            self._scratch = np.empty((3, max(cruise.size, 2 * self._scratch.shape[1])))
+        fms_modes = self._scratch[0, :cruise.size]
+        for k, idx in enumerate(cruise):
+            fms_modes[k] = self._current_fms_mode(idx)
+        idx_own = cruise[fms_modes == 2]  # AFMS_MODE OWN
+        idx_rta = cruise[fms_modes == 3]  # AFMS_MODE RTA
+        idx_tw = cruise[fms_modes == 4]  # AFMS_MODE TW
+
+        spd_idx = []  # aircraft that get a new speed
+        spd = []  # new speed: CAS [m/s] or Mach
+
+        for idx in idx_own:
+            own_spd = self._current_own_spd(idx)
+            if own_spd < 0:
+                print('No own speed specified')
             else:
-                pass
+                spd_idx.append(idx)
+                spd.append(own_spd)
+
+        # Distance to the active waypoint for all RTA and TW aircraft in one call
+        idx_rtw = np.concatenate((idx_rta, idx_tw))
+        if idx_rtw.size:
+            wplat, wplon = self._scratch[1:, :idx_rtw.size]
+            for k, idx in enumerate(idx_rtw):
+                route = routes[idx]
+                wplat[k] = route.wplat[route.iactwp]
+                wplon[k] = route.wplon[route.iactwp]
+            _, dist2nwp = tools.geo.qdrdist(traf.lat[idx_rtw], traf.lon[idx_rtw], wplat, wplon)
+            dist2nwp = np.atleast_1d(dist2nwp)
+            now_s = _seconds_of_day(sim.utc.time())
+
+            nrta = len(idx_rta)
+            if nrta:
+                rta_cas_m_s, has_rta = self._rta_mode_cas(idx_rta, dist2nwp[:nrta], now_s)
+                spd_idx.extend(idx_rta[has_rta])
+                spd.extend(rta_cas_m_s[has_rta])
+            for idx, dist2nwp_tw in zip(idx_tw, dist2nwp[nrta:]):
+                cas_m_s = self._tw_mode_cas(idx, dist2nwp_tw, now_s)
+                if cas_m_s is not None:
+                    spd_idx.append(idx)
+                    spd.append(cas_m_s)
+
+        # Select all new speeds in one autopilot call (CAS [m/s] or Mach), then
+        # switch VNAV back on for each aircraft, as SPD switches it off
+        if spd_idx:
+            spd_idx = np.array(spd_idx)
+            traf.ap.selspdcmd(spd_idx, np.array(spd, dtype=float))
+            for idx in spd_idx:
+                traf.ap.setVNAV(idx, True)
+
+    def _rta_mode_cas(self, idx_rta, dist2nwp, now_s):
+        """
+        CAS for all aircraft in AFMS mode RTA, solved in one batch
+        :param idx_rta: aircraft indices
+        :param dist2nwp: distance to the active waypoint per aircraft [nm]
+        :param now_s: current simulation time in seconds of the day
+        :return: CAS in m/s per aircraft, mask of the aircraft that have an RTA set
+        """
+        routes = traf.ap.route
+        segments = []
+        for idx in idx_rta:
+            rta_init_index, rta_last_index, rta = self._current_rta(idx)
+            time_s2rta = 0
+            if rta_init_index > -1:
+                time_s2rta = self._time_s2rta(rta, now_s)
+                if time_s2rta < self.skip2next_rta_time_s:
+                    rta_init_index, rta_last_index, rta = self._current_rta_plus_one(idx)
+                    time_s2rta = self._time_s2rta(rta, now_s)
+            segments.append((rta_init_index, rta_last_index, time_s2rta))
+
+        # Ragged route segments padded into one array per quantity, with the number of sections per aircraft
+        nsections = np.array([rta_last_index - rta_init_index + 1 if rta_init_index > -1 else 0
+                              for rta_init_index, rta_last_index, _ in segments], dtype=np.int64)
+        distances = np.zeros((len(segments), max(nsections.max(), 1)))
+        flightlevels = np.zeros_like(distances)
+        alt = traf.alt[idx_rta]
+        for k, (idx, (rta_init_index, rta_last_index, _)) in enumerate(zip(idx_rta, segments)):
+            if nsections[k]:
+                self._route_segment(routes[idx], dist2nwp[k], alt[k], rta_init_index,
+                                    rta_last_index, distances[k], flightlevels[k])
+        time_s2rta = np.array([segment[2] for segment in segments], dtype=np.float64)
+        cas_m_s = _rta_cas_wfl_batch(distances * nm, flightlevels, nsections, time_s2rta,
+                                     np.asarray(traf.cas[idx_rta], dtype=np.float64))
+        return cas_m_s, nsections > 0
+
+    def _tw_mode_cas(self, idx, dist2nwp, now_s):
+        """
+        CAS for an aircraft in AFMS mode TW
+        :param idx: aircraft index
+        :param dist2nwp: distance to the active waypoint [nm]
+        :param now_s: current simulation time in seconds of the day
+        :return: CAS in m/s, or None when no RTA is set
+        """
+        rta_init_index, rta_last_index, rta = self._current_rta(idx)
+        if rta_init_index < 0:
+            return None
+        route = traf.ap.route[idx]
+        tw_size = float(route.wprta_window_size[rta_last_index])
+        alt = traf.alt[idx]
+        cas = traf.cas[idx]
+        distances, flightlevels = self._route_segment(route, dist2nwp, alt, rta_init_index, rta_last_index)
+
+        own_spd = self._current_own_spd(idx)
+        if own_spd < 0:
+            # No speed specified. Use current speed
+            preferred_cas_m_s = cas
+        elif own_spd < 1:
+            # Mach speed specified
+            preferred_cas_m_s = tools.aero.vmach2cas(own_spd, alt)
+        else:
+            # CAS specified
+            preferred_cas_m_s = own_spd
+
+        eta_s_preferred = self._eta_wfl(distances, flightlevels, preferred_cas_m_s)
+        time_s2rta = self._time_s2rta(rta, now_s)
+        if eta_s_preferred < self.skip2next_rta_time_s:
+            # Too close: aim for the RTA beyond, if there is one (only then the segment and ETA change)
+            beyond_rta_index = route.next_rta(rta_last_index + 1)
+            if beyond_rta_index > -1:
+                rta_last_index = beyond_rta_index
+                rta = route.wprta[beyond_rta_index]
+                time_s2rta = self._time_s2rta(rta, now_s)
+                distances, flightlevels = self._route_segment(route, dist2nwp, alt, rta_init_index, rta_last_index)
+                eta_s_preferred = self._eta_wfl(distances, flightlevels, preferred_cas_m_s)
+        earliest_time_s2rta = time_s2rta - tw_size/2
+        latest_time_s2rta = time_s2rta + tw_size/2
+        if earliest_time_s2rta <= eta_s_preferred <= latest_time_s2rta:
+            return preferred_cas_m_s
+        else:
+            # Aim for the nearest edge of the time window
+            target_time_s2rta = min(max(eta_s_preferred, earliest_time_s2rta), latest_time_s2rta)
+            return self._rta_cas_wfl(distances, flightlevels, target_time_s2rta, cas)
+
+    def _route_segment(self, route, dist2nwp, alt, rta_init_index, rta_last_index,
+                       distances=None, flightlevels=None):
+        """
+        Distances and flightlevels of the route sections from the aircraft to the RTA waypoint.
+        Without output arrays, the result is a view on a buffer that is reused by the next call.
+        :param route: route of the aircraft
+        :param dist2nwp: distance to the active waypoint [nm]
+        :param alt: altitude of the aircraft [m]
+        :param rta_init_index: active waypoint index
+        :param rta_last_index: RTA waypoint index
+        :param distances: optional output array, filled from the start
+        :param flightlevels: optional output array, filled from the start
+        :return: distances [nm], flightlevels [m]
+        """
+        n = rta_last_index - rta_init_index + 1
+        if distances is None:
+            if n > self._segment_buf.shape[1]:
+                self._segment_buf = np.empty((2, max(n, 2 * self._segment_buf.shape[1])))
+            distances, flightlevels = self._segment_buf
+        distances = distances[:n]
+        flightlevels = flightlevels[:n]
+        distances[0] = dist2nwp
+        distances[1:] = route.wpdistto[rta_init_index + 1:rta_last_index + 1]
+        flightlevels[0] = alt
+        flightlevels[1:] = route.wpalt[rta_init_index + 1:rta_last_index + 1]
+        return distances, flightlevels
 
     def reset(self):
-        pass
+        self._any_afms_active = False
 
     def _current_fms_mode(self, idx):
         """
@@ -302,73 +615,43 @@ class Afms:
         :param idx: aircraft index
         :return: fms mode
         """
-        fms_mode_index = next((index for index, value in reversed(list(enumerate(traf.ap.route[idx].wpfms_mode[
-                                                                                 :traf.ap.route[idx].iactwp])))
-                               if value != 1), -1)
-        if fms_mode_index < 0:
-            return 0  # FMS MODE OFF
-        else:
-            return traf.ap.route[idx].wpfms_mode[:traf.ap.route[idx].iactwp][fms_mode_index]
+        return traf.ap.route[idx].afms_active()[0]
 
     def _current_rta(self, idx):
         """
         Identify active rta
         :param idx: aircraft index
-        :return: initial index rta, last index rta, rta: active rta
+        :return: initial index rta, last index rta, rta: active rta [s of the day]
         """
-        rta_index = next((index for index, value in enumerate(traf.ap.route[idx].wprta[traf.ap.route[idx].iactwp:]) if
-                          isinstance(value, time)), -1)
-        rta = traf.ap.route[idx].wprta[traf.ap.route[idx].iactwp:][rta_index] if rta_index > -1 else -1
+        route = traf.ap.route[idx]
+        rta_index = route.next_rta(route.iactwp)
         if rta_index > -1:
-            # print(f'current rta {traf.ap.route[idx].iactwp} {rta_index} {rta}')
-            return traf.ap.route[idx].iactwp, traf.ap.route[idx].iactwp + rta_index, rta
+            return route.iactwp, rta_index, route.wprta[rta_index]
         else:
-            return -1, -1, rta
+            return -1, -1, -1
 
     def _current_rta_plus_one(self, idx):
         """
         Identify rta beyond active rta
         :param idx: aircraft index
-        :return: initial index active rta, last index rta beyond activate rta, rta: rta beyond activate rta
+        :return: initial index active rta, last index rta beyond activate rta,
+                 rta: rta beyond activate rta [s of the day]
         """
         init_index_rta, last_index_active_rta, active_rta = self._current_rta(idx)
-        beyond_rta_index = next((index for index, value in enumerate(traf.ap.route[idx].wprta[last_index_active_rta+1:]) if
-                          isinstance(value, time)), -1)
-        beyond_rta = traf.ap.route[idx].wprta[last_index_active_rta+1:][beyond_rta_index] if beyond_rta_index > -1 else -1
+        route = traf.ap.route[idx]
+        beyond_rta_index = route.next_rta(last_index_active_rta + 1)
         if beyond_rta_index > -1:
-            # print(f'new beyond {init_index_rta} {last_index_active_rta} {beyond_rta_index} {active_rta} {beyond_rta}')
-            return init_index_rta, last_index_active_rta + 1 + beyond_rta_index, beyond_rta
+            return init_index_rta, beyond_rta_index, route.wprta[beyond_rta_index]
         else:
             return init_index_rta, last_index_active_rta, active_rta
 
-
     def _current_own_spd(self, idx):
         """
         Identify active own Mach or CAS
         :param idx: aircraft index
         :return: Mach or CAS (or -1 in no speed is specified)
         """
-        own_spd_index = next((index for index, value in reversed(list(enumerate(traf.ap.route[idx].wpown[
-                                                                                 :traf.ap.route[idx].iactwp])))
-                               if value >= 0), -1)
-        if own_spd_index < 0:
-            return -1  # NO OWN SPEED SPECIFIED
-        else:
-            return traf.ap.route[idx].wpown[:traf.ap.route[idx].iactwp][own_spd_index]
-
-    def _current_tw_size(self, idx):
-        """
-        Identify active time window size
-        :param idx: aircraft index
-        :return: initial index tw, last index tw, time_window_size: active tw
-        """
-        rta_index = next((index for index, value in enumerate(traf.ap.route[idx].wprta[traf.ap.route[idx].iactwp:]) if
-                          isinstance(value, time)), -1)
-        tw_size = traf.ap.route[idx].wprta_window_size[traf.ap.route[idx].iactwp:][rta_index] if rta_index > -1 else 60.0
-        if rta_index > -1:
-            return traf.ap.route[idx].iactwp, traf.ap.route[idx].iactwp + rta_index, tw_size
-        else:
-            return -1, -1, tw_size
+        return traf.ap.route[idx].afms_active()[1]
 
     def afms_from(self, idx, *args):
         if len(args) < 2 or len(args) > 3:
@@ -376,8 +659,8 @@ class Afms:
         else:
             name = args[0]
             mode = args[1]
-            if name in traf.ap.route[idx].wpname:
-                wpidx = traf.ap.route[idx].wpname.index(name)
+            wpidx = traf.ap.route[idx].wp_index(name)
+            if wpidx > -1:
                 if mode in self._fms_modes:
                     if mode == self._fms_modes[0]:
                         traf.ap.route[idx].wpfms_mode[wpidx] = 0
@@ -389,6 +672,8 @@ class Afms:
                         traf.ap.route[idx].wpfms_mode[wpidx] = 4
                     else:
                         traf.ap.route[idx].wpfms_mode[wpidx] = 1  # CONTINUE
+                    traf.ap.route[idx].afms_changed(wpidx)
+                    self._any_afms_active = True
                 else:
                     return False, mode + 'does not exist' + traf.id[idx]
             else:
@@ -400,9 +685,9 @@ class Afms:
         else:
             name = args[0]
             rta_time = args[1]
-            if name in traf.ap.route[idx].wpname:
-                wpidx = traf.ap.route[idx].wpname.index(name)
-                traf.ap.route[idx].wprta[wpidx] = datetime.strptime(rta_time, '%H:%M:%S').time()
+            wpidx = traf.ap.route[idx].wp_index(name)
+            if wpidx > -1:
+                traf.ap.route[idx].set_rta(wpidx, _hms2seconds(rta_time))
             else:
                 return False, name + 'not found in route' + traf.id[idx]
 
@@ -412,8 +697,8 @@ class Afms:
         else:
             name = args[0]
             tw_size = args[1]
-            if name in traf.ap.route[idx].wpname:
-                wpidx = traf.ap.route[idx].wpname.index(name)
+            wpidx = traf.ap.route[idx].wp_index(name)
+            if wpidx > -1:
                 traf.ap.route[idx].wprta_window_size[wpidx] = tw_size
             else:
                 return False, name + 'not found in route' + traf.id[idx]
@@ -427,9 +712,9 @@ class Afms:
             name = args[0]
             rta_time = args[1]
             tw_size = args[2]
-            if name in traf.ap.route[idx].wpname:
-                wpidx = traf.ap.route[idx].wpname.index(name)
-                traf.ap.route[idx].wprta[wpidx] = datetime.strptime(rta_time, '%H:%M:%S').time()
+            wpidx = traf.ap.route[idx].wp_index(name)
+            if wpidx > -1:
+                traf.ap.route[idx].set_rta(wpidx, _hms2seconds(rta_time))
                 traf.ap.route[idx].wprta_window_size[wpidx] = tw_size
             else:
                 return False, name + 'not found in route' + traf.id[idx]
@@ -437,77 +722,37 @@ class Afms:
     def own_from(self, idx, *args):
         if len(args) == 1:
             name = args[0]
-            if name in traf.ap.route[idx].wpname:
-                wpidx = traf.ap.route[idx].wpname.index(name)
+            wpidx = traf.ap.route[idx].wp_index(name)
+            if wpidx > -1:
                 traf.ap.route[idx].wpown[wpidx] = traf.perf.macr[idx]
+                traf.ap.route[idx].afms_changed(wpidx)
             else:
                 return False, name + 'not found in route' + traf.id[idx]
         elif len(args) == 2:
             name = args[0]
             own_spd_index = args[1]
-            if name in traf.ap.route[idx].wpname:
-                wpidx = traf.ap.route[idx].wpname.index(name)
+            wpidx = traf.ap.route[idx].wp_index(name)
+            if wpidx > -1:
                 traf.ap.route[idx].wpown[wpidx] = own_spd_index
+                traf.ap.route[idx].afms_changed(wpidx)
             else:
                 return False, name + 'not found in route' + traf.id[idx]
         else:
             return False, 'OWN_SPD_FROM needs 2 or 3 arguments'
 
-    def _time2rta(self, time2):
-        """
-        Calculate time to next RTA waypoint
-        :param time2: RTA in time format
-        :return: time in time format
-        """
-        time1 = sim.utc.time()
-        time_format = '%H:%M:%S'
-        tdelta = datetime.strptime(time2.strftime(time_format), time_format) -\
-                 datetime.strptime(time1.strftime(time_format), time_format)
-        if tdelta.days < 0:
-            tdelta = timedelta(days=0, seconds=tdelta.seconds, microseconds=tdelta.microseconds)
-        return tdelta
-
-    def _time_s2rta(self, time2):
+    def _time_s2rta(self, time2, now_s=None):
         """
         Calculate time in seconds to next RTA waypoint
-        :param time2: RTA in time format
-        :return: time in seconds
+        :param time2: RTA in seconds of the day
+        :param now_s: current time in seconds of the day (default: read from sim.utc)
+        :return: time in seconds (negative if the RTA has passed)
         """
-        time1 = sim.utc.time()
-        time_format = '%H:%M:%S'
-        tdelta = datetime.strptime(time2.strftime(time_format), time_format) -\
-                 datetime.strptime(time1.strftime(time_format), time_format)
-        if tdelta.days < 0:
-            tdelta = timedelta(days=0, seconds=tdelta.seconds, microseconds=tdelta.microseconds)
-            return tdelta.seconds - 86400
-        else:
-            return tdelta.seconds
+        if now_s is None:
+            now_s = _seconds_of_day(sim.utc.time())
+        return time2 - now_s
 
     def _rta_spd(self, distance_nm, time_s, current_tas_m_s):
-        acceleration_m_s2 = 1.94  # See standard coefficients for Bluesky
-        deceleration_m_s2 = -1.265
-        distance_m = distance_nm * 1852
-        if time_s > 60:  # TODO From which time before it is not usefull anymore to change the speed?
-            if distance_m / time_s > current_tas_m_s:
-                #Acceleration
-                a = acceleration_m_s2
-            else:
-                #Deceleration
-                a = deceleration_m_s2
-            try:
-                t1_s = time_s - 1/a * sqrt(a*a*time_s*time_s + 2*a*current_tas_m_s*time_s - 2*a*distance_m)
-            except ValueError:
-                t1_s = 0.0
-            if t1_s > time_s:
-                tas2_m_s = current_tas_m_s + a*time_s
-            else:
-                tas2_m_s = current_tas_m_s + a * t1_s
-        else:
-            t1_s = 0.0
-            a = 0.0
-            tas2_m_s = current_tas_m_s
-
-        return tas2_m_s  # TODO Do I need a speed limiter, or just let Bluesky handle this?
+        return _rta_spd(float(distance_nm), float(time_s), float(current_tas_m_s))
 
     def _rta_cas_wfl(self, distances, flightlevels, time_s, current_cas_m_s):
         """
@@ -519,48 +764,8 @@ class Afms:
         :param current_cas_m_s: current CAS in m/s
         :return: CAS in m/s
         """
-        acceleration_m_s2 = 1.94/2  # See standard coefficients for Bluesky
-        deceleration_m_s2 = -1.265/2
-        distances_m = distances * 1852
-        iterations = 3
-        estimated_cas_m_s = current_cas_m_s
-        current_tas_m_s = tools.aero.vcas2tas(current_cas_m_s, flightlevels[0])
-
-        for it in range(iterations):
-            times_s = np.empty_like(distances)
-            previous_fl_m = flightlevels[0]
-            for i, distance_m in enumerate(distances_m):
-                if flightlevels[i] < 0:
-                    next_fl = previous_fl_m
-                else:
-                    next_fl = flightlevels[i]
-                next_tas_m_s = tools.aero.vcas2tas(estimated_cas_m_s, next_fl)
-                if i == 0:
-                    if estimated_cas_m_s > current_cas_m_s + 1.0:
-                        #Accelerate
-                        a = acceleration_m_s2
-                        delta_time_s = (next_tas_m_s - current_tas_m_s) / a
-                        delta_dist_m = 0.5 * a * delta_time_s ** 2 + current_tas_m_s * delta_time_s
-                    elif estimated_cas_m_s < current_cas_m_s - 1.0:
-                        #Decelerate
-                        a = deceleration_m_s2
-                        delta_time_s = (-next_tas_m_s + current_tas_m_s) / a
-                        delta_dist_m = 0.5 * a * delta_time_s ** 2 + current_tas_m_s * delta_time_s
-                    else:
-                        # No speed change
-                        delta_time_s = 0.0
-                        delta_dist_m = 0.0
-
-                    step_time_s = (distance_m - delta_dist_m) / next_tas_m_s + delta_time_s
-                else:
-                    step_time_s = distance_m / next_tas_m_s
-
-                times_s[i] = step_time_s
-
-            total_time_s = np.sum(times_s)
-            cas_rta_m_s = estimated_cas_m_s
-            estimated_cas_m_s = cas_rta_m_s * total_time_s / time_s
-        return cas_rta_m_s
+        return _rta_cas_wfl(distances * nm, np.asarray(flightlevels, dtype=np.float64),
+                            np.float64(time_s), np.float64(current_cas_m_s))
 
     def _eta_wfl(self, distances, flightlevels, current_cas_m_s):
         """
@@ -571,34 +776,8 @@ class Afms:
         :param current_cas_m_s: current CAS in m/s
         :return: ETA
         """
-        distances_m = distances * 1852
-        times_s = np.empty_like(distances)
-        previous_fl_m = flightlevels[0]
-
-        for i, distance_m in enumerate(distances_m):
-            if flightlevels[i] < 0:
-                next_fl = previous_fl_m
-            else:
-                next_fl = flightlevels[i]
-            next_tas_m_s = tools.aero.vcas2tas(current_cas_m_s, next_fl)
-            step_time_s = distance_m / next_tas_m_s
-            times_s[i] = step_time_s
-
-        total_time_s = np.sum(times_s)
-        return total_time_s
+        return _eta_wfl(np.asarray(distances, dtype=np.float64), np.asarray(flightlevels, dtype=np.float64),
+                        np.float64(current_cas_m_s))
 
     def _eta_preferred_spd(self, distance_nm, current_tas_m_s, preferred_tas_m_s):
-        acceleration_m_s2 = 1.94  # See standard coefficients for Bluesky
-        deceleration_m_s2 = -1.265
-        distance_m = distance_nm * 1852
-        if preferred_tas_m_s > current_tas_m_s:
-            #Acceleration
-            a = acceleration_m_s2
-        else:
-            #Deceleration
-            a = deceleration_m_s2
-        t2_s = (distance_m - 1 / (2 * a) * (preferred_tas_m_s ** 2 - current_tas_m_s ** 2)) / preferred_tas_m_s
-        if t2_s < 0:
-            return 0.0
-        else:
-            return t2_s
+        return _eta_preferred_spd(float(distance_nm), float(current_tas_m_s), float(preferred_tas_m_s))
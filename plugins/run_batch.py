@@ -1,34 +1,73 @@
-from bluesky import stack, traf, sim
+from bluesky import settings, stack, traf, sim
+import csv
 import pickle
 import os
+import posixpath
+import numpy as np
 import pandas as pd
 
+try:
+    import pyarrow as pa
+    from pyarrow import feather
+except ImportError:
+    pa = feather = None
+    print('RUN_BATCH: pyarrow not available, results are stored as pickle.')
+
+# Flight state of the aircraft in the current batch scenario
+WAITING, FLYING, LANDED = 0, 1, 2
+
+# Folder with the batch scenarios, relative to the scenario path
+settings.set_variable_defaults(batch_path='batch')
+
 
 class Batch:
     def __init__(self):
+        self.folder = os.path.join(settings.scenario_path, settings.batch_path)
         self.ic = []
+        self.ic_cmds = []  # IC command for every scenario in self.ic
+        self.nscn = 0  # number of scenarios, len(self.ic)
         self.nc = []
         self.running = False
-        self.takeoff = False
-
-        self.ensembles = []
-        self.results_list = []
+        self.flight_state = WAITING
+
+        self.nens = 0  # number of ensemble members in the loaded wind field
+        # Result columns, one row per scenario run
+        self.result_ids = []
+        self.result_times = []
+        self.result_fuel = np.empty(0)
+        self.nresults = 0  # number of filled rows in the result columns
+        self.results_file = None  # csv file to which every result is written as soon as it is known
+        self.results_writer = None
         self.current_scn = 0
         self.current_ens = 1
+        self.first_ens = 1  # first ensemble member of this batch
+        self.last_ens = None  # last ensemble member of this batch, None: all members
+        self.results_path = os.path.abspath(os.path.join('output', 'results'))  # results file without extension
 
     def update(self):
         # it the batch is running, check if the ac has landed
         if self.running:
+            # Restore fast-time when the scenario itself switched it off (OP, HOLD, FF nsec)
             if not sim.ffmode:
                 stack.stack('run')
                 stack.stack('FF')
 
-            if not self.takeoff and traf.alt[0] > 10:
-                self.takeoff = True
+            state = self.flight_state
+            if state == WAITING and traf.alt[0] > 10:
+                self.flight_state = state = FLYING
 
-            if self.takeoff and not traf.swlnav[0]:
+            if state == FLYING and not traf.swlnav[0]:
+                self.flight_state = LANDED
                 stack.stack('hold')
-                self.results_list.append([self.ic[self.current_scn-1], sim.utc.time(), traf.perf.mass])
+                # The batch follows the first aircraft, store its mass only
+                mass = traf.perf.mass
+                name, time, fuel = self.ic[self.current_scn-1], sim.utc.time(), float(mass[0])
+                self.results_writer.writerow((name, time, fuel))
+                self.results_file.flush()  # Keep the results of finished runs if the batch is aborted
+                self.result_ids[self.nresults] = name
+                self.result_times[self.nresults] = time
+                self.result_fuel[self.nresults] = fuel
+                self.nresults += 1
                 self._next()
         else:
             self.start('test', 'data/weather/1day.nc')
@@ -39,34 +78,83 @@ class Batch:
     def reset(self):
         pass
 
-    def start(self, ic, nc):
-        folder = '/home/remonvandenbra/repo/bluesky/scenario/batch'
-        for f in os.listdir(folder):
-            if f.endswith('.scn'):
-                self.ic.append(f)
+    def start(self, ic, nc, first_ens=1, last_ens=None):
+        """
+        Run all batch scenarios for the ensemble members first_ens to last_ens.
+        Separate BlueSky nodes can each run their own range of members in parallel,
+        every range is then stored in its own results file.
+        """
+        self.current_ens = first_ens
+        self.first_ens = first_ens
+        self.last_ens = last_ens
+        # Resolve the output folder once, and create it if needed
+        output = os.path.abspath('output')
+        os.makedirs(output, exist_ok=True)
+        self.results_path = os.path.join(output, 'results' if last_ens is None else
+                                         f'results_ens{first_ens}-{last_ens}')
+
+        # Scenario files in a fixed order, the directory is read lazily and closed right after
+        with os.scandir(self.folder) as entries:
+            self.ic = sorted(entry.name for entry in entries
+                             if entry.name.endswith('.scn') and entry.is_file())
+        self.nscn = len(self.ic)
+        # Stack commands are platform independent, so always join with '/'
+        self.ic_cmds = ['IC ' + posixpath.join(settings.batch_path, fname) for fname in self.ic]
+
+        # One result per scenario for the first ensemble member, the rows for the other
+        # members are added once the wind file is loaded (see _next)
+        self.result_ids = [None] * self.nscn
+        self.result_times = [None] * self.nscn
+        self.result_fuel = np.empty(self.nscn)
+        self.nresults = 0
+        if self.results_file is not None:  # left open by an aborted batch
+            self.results_file.close()
+        self.results_file = open(self.results_path + '.csv', 'w', newline='')
+        self.results_writer = csv.writer(self.results_file)
+        self.results_writer.writerow(('id', 'time', 'fuel'))
 
         self.nc = nc
-        stack.stack('load_wind {} {}'.format(self.current_ens, self.nc))
+        stack.stack(f'load_wind {self.current_ens} {self.nc}')
         self.running = True
         self._next()
-        stack.stack('IC batch/{}'.format(self.ic[0]))
 
     def _next(self):
-        self.ensembles = traf.wind.ens
-        if self.current_scn > len(self.ic)-1:  # if end of scns?)
-            if self.current_ens < len(self.ensembles):
-                self.current_ens = self.current_ens + 1
-                print(self.current_ens)
-                stack.stack('load_wind {} {}'.format(self.current_ens, self.nc))
-                self.current_scn = 0
-                self._next()
-            else:  # done, store data and go home
-                df = pd.DataFrame(columns=['id', 'time', 'fuel'], data=self.results_list)
-                pickle.dump(df, open('output/results.p', 'wb'))
-        else:  # switch to the next scn file
-            stack.stack('IC batch/{}'.format(self.ic[self.current_scn]))
+        while True:
+            if self.current_scn >= self.nscn:  # if end of scns?)
+                # The ensembles only need to be known once all scenarios of a member are done
+                self.nens = len(traf.wind.ens)
+                last_ens = self.nens if self.last_ens is None else min(self.last_ens, self.nens)
+                if self.current_ens < last_ens:
+                    # Allocate the rows of all remaining members at once
+                    nextra = self.nscn * (last_ens - self.first_ens + 1) - len(self.result_ids)
+                    if nextra > 0:
+                        self.result_ids += [None] * nextra
+                        self.result_times += [None] * nextra
+                        self.result_fuel = np.concatenate((self.result_fuel, np.empty(nextra)))
+                    self.current_ens = self.current_ens + 1
+                    print(self.current_ens)
+                    stack.stack(f'load_wind {self.current_ens} {self.nc}')
+                    self.current_scn = 0
+                    continue  # start with the first scn file of the new ensemble member
+                # done, store data and go home
+                self.results_file.close()
+                n = self.nresults
+                columns = {'id': self.result_ids[:n], 'time': self.result_times[:n], 'fuel': self.result_fuel[:n]}
+                if pa is not None:
+                    # Columnar Arrow file, written straight from the result columns without a DataFrame
+                    table = pa.table({name: pa.array(values) for name, values in columns.items()})
+                    feather.write_feather(table, self.results_path + '.feather', compression='zstd')
+                else:
+                    # Build the DataFrame from ready-made columns, no type inference over rows
+                    df = pd.DataFrame(columns, copy=False)
+                    with open(self.results_path + '.p', 'wb') as f:
+                        pickle.dump(df, f, protocol=pickle.HIGHEST_PROTOCOL)
+                return
+            # switch to the next scn file
+            stack.stack(self.ic_cmds[self.current_scn])
             self.current_scn = self.current_scn + 1
-            self.takeoff = False
+            self.flight_state = WAITING
+            return
 
 
 batch = Batch()
@@ -110,10 +198,10 @@ def init_plugin():
         # The command name for your function
         'RUN_BATCH': [
             # A short usage string. This will be printed if you type HELP <name> in the BlueSky console
-            'RUN_BATCH ic_folder nc',
+            'RUN_BATCH ic_folder nc [first_ens, last_ens]',
 
             # A list of the argument types your function accepts. For a description of this, see ...
-            '[txt, txt]',
+            '[txt, txt, int, int]',
 
             # The name of your function in this plugin
             run,
@@ -126,5 +214,5 @@ def init_plugin():
     return config, stackfunctions
 
 
-def run(ic, nc):
-    batch.start(ic, nc)
+def run(ic, nc, first_ens=1, last_ens=None):
+    batch.start(ic, nc, first_ens, last_ens)